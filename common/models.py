@@ -1,98 +1,471 @@
+import asyncio
+import json
 import os
+import shelve
 from abc import ABC, abstractmethod
+from functools import cache
+from hashlib import sha256
+from types import SimpleNamespace
 
+import httpx
+import numpy as np
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import NOT_GIVEN, AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+from pydantic import BaseModel
+
+# .env is read once at import, providers are configured from this snapshot
+load_dotenv(".env")
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+MODEL_PROVIDER = os.getenv("MODEL_PROVIDER", "openai").lower()
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "openai/gpt-4o")
+
+LLM_CACHE = _env_flag("LLM_CACHE", "true")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache")
+SEMANTIC_CACHE = _env_flag("SEMANTIC_CACHE", "false")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+STREAM_COMPLETIONS = _env_flag("STREAM_COMPLETIONS", "false")
+
+
+_HTTP_TIMEOUT = httpx.Timeout(30.0)
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+# The SDK retries 429/5xx with backoff, the transport retries failed connects
+_MAX_RETRIES = 4
+_CONNECT_RETRIES = 2
+
+
+@cache
+def _shared_http_clients() -> tuple[httpx.Client, httpx.AsyncClient]:
+    # one keep-alive HTTP/2 pool per process, reused by every provider (needs httpx[http2])
+    return (
+        DefaultHttpxClient(
+            timeout=_HTTP_TIMEOUT,
+            transport=httpx.HTTPTransport(http2=True, limits=_HTTP_LIMITS, retries=_CONNECT_RETRIES),
+        ),
+        DefaultAsyncHttpxClient(
+            timeout=_HTTP_TIMEOUT,
+            transport=httpx.AsyncHTTPTransport(http2=True, limits=_HTTP_LIMITS, retries=_CONNECT_RETRIES),
+        ),
+    )
 
 
 class ModelProvider(ABC):
     @abstractmethod
-    def chat_completion(self, messages, response_format, model=None, max_completion_tokens=None):
+    def chat_completion(self, messages, response_format, model=None, max_completion_tokens=None, temperature=NOT_GIVEN):
+        pass
+
+    @abstractmethod
+    async def achat_completion(
+        self, messages, response_format, model=None, max_completion_tokens=None, temperature=NOT_GIVEN
+    ):
         pass
 
 
+class _JsonObjectReader:
+    """Collects streamed text until the top-level JSON object is closed"""
+
+    def __init__(self):
+        self.parts = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+
+    def feed(self, text: str) -> bool:
+        for i, ch in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(text[: i + 1])
+                    self.done = True
+                    return True
+        self.parts.append(text)
+        return False
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+
+@cache
+def _prompt_cache_key(system_prompt: str) -> str:
+    return "sgr-" + sha256(system_prompt.encode()).hexdigest()[:16]
+
+
+def _prompt_cache_body(messages):
+    # Route requests sharing a system prompt to OpenAI's prompt cache, a changed prompt gets a new key
+    if messages and messages[0].get("role") == "system":
+        return {"prompt_cache_key": _prompt_cache_key(messages[0]["content"])}
+    return None
+
+
 class OpenAIProvider(ModelProvider):
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
-
-    def chat_completion(self, messages, response_format, model="gpt-4o", max_completion_tokens=1000):
-        completion = self.client.beta.chat.completions.parse(
-            model=model,
-            response_format=response_format,
-            messages=messages,
-            max_completion_tokens=max_completion_tokens,
+    def __init__(self, api_key: str, http_client=None, async_http_client=None, stream: bool = False):
+        self.client = OpenAI(api_key=api_key, max_retries=_MAX_RETRIES, timeout=_HTTP_TIMEOUT, http_client=http_client)
+        self.async_client = AsyncOpenAI(
+            api_key=api_key, max_retries=_MAX_RETRIES, timeout=_HTTP_TIMEOUT, http_client=async_http_client
         )
+        self.stream = stream
+
+    def chat_completion(
+        self, messages, response_format, model="gpt-4o", max_completion_tokens=1000, temperature=NOT_GIVEN
+    ):
+        kwargs = {
+            "model": model,
+            "response_format": response_format,
+            "messages": messages,
+            "max_completion_tokens": max_completion_tokens,
+            "temperature": temperature,
+            "extra_body": _prompt_cache_body(messages),
+        }
+        if self.stream:
+            # stop reading as soon as the answer is a complete JSON object
+            reader = _JsonObjectReader()
+            with self.client.beta.chat.completions.stream(**kwargs) as stream:
+                for event in stream:
+                    if event.type == "content.delta" and reader.feed(event.delta):
+                        break
+            # an unfinished object (truncation, refusal) is left to the caller's parse to report
+            return _completion_from_content(reader.content)
+
+        completion = self.client.beta.chat.completions.parse(**kwargs)
         return completion
 
+    async def achat_completion(
+        self, messages, response_format, model="gpt-4o", max_completion_tokens=1000, temperature=NOT_GIVEN
+    ):
+        kwargs = {
+            "model": model,
+            "response_format": response_format,
+            "messages": messages,
+            "max_completion_tokens": max_completion_tokens,
+            "temperature": temperature,
+            "extra_body": _prompt_cache_body(messages),
+        }
+        if self.stream:
+            reader = _JsonObjectReader()
+            async with self.async_client.beta.chat.completions.stream(**kwargs) as stream:
+                async for event in stream:
+                    if event.type == "content.delta" and reader.feed(event.delta):
+                        break
+            return _completion_from_content(reader.content)
+
+        completion = await self.async_client.beta.chat.completions.parse(**kwargs)
+        return completion
+
+
+# Patched response_format payloads per pydantic model - the schema never changes between calls
+_SCHEMA_CACHE: dict[type[BaseModel], dict] = {}
 
-class OpenRouterProvider(ModelProvider):
-    def __init__(self, api_key: str):
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key,
-        )
 
-    def chat_completion(self, messages, response_format, model="openai/gpt-4o", max_completion_tokens=1000):
+# Ensure additionalProperties: false for all object schemas (required by OpenAI)
+def _ensure_no_additional_properties(schema_dict):
+    # explicit stack instead of recursion - nested unions produce deep schemas
+    stack = [schema_dict]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get("type") == "object" and "additionalProperties" not in node:
+                node["additionalProperties"] = False
+            stack.extend(value for value in node.values() if isinstance(value, (dict, list)))
+        else:
+            stack.extend(item for item in node if isinstance(item, (dict, list)))
+
+
+def _response_format_schema(response_format: type[BaseModel]) -> dict:
+    # The cached dict is shared between calls, treat it as read-only
+    schema = _SCHEMA_CACHE.get(response_format)
+    if schema is None:
         # Convert Pydantic model to JSON schema format for OpenRouter
         json_schema = response_format.model_json_schema()
-
-        # Ensure additionalProperties: false for all object schemas (required by OpenAI)
-        def ensure_no_additional_properties(schema_dict):
-            if isinstance(schema_dict, dict):
-                if schema_dict.get("type") == "object" and "additionalProperties" not in schema_dict:
-                    schema_dict["additionalProperties"] = False
-                for key, value in schema_dict.items():
-                    if isinstance(value, dict):
-                        ensure_no_additional_properties(value)
-                    elif isinstance(value, list):
-                        for item in value:
-                            if isinstance(item, dict):
-                                ensure_no_additional_properties(item)
-
-        ensure_no_additional_properties(json_schema)
+        _ensure_no_additional_properties(json_schema)
 
         schema = {
             "type": "json_schema",
             "json_schema": {"name": response_format.__name__.lower(), "strict": True, "schema": json_schema},
         }
+        _SCHEMA_CACHE[response_format] = schema
+    return schema
 
-        completion = self.client.chat.completions.create(
-            model=model,
-            response_format=schema,
-            messages=messages,
-            max_completion_tokens=max_completion_tokens,
+
+class OpenRouterProvider(ModelProvider):
+    def __init__(self, api_key: str, http_client=None, async_http_client=None, stream: bool = False):
+        self.client = OpenAI(
+            base_url="https://openrouter.ai/api/v1",
+            api_key=api_key,
+            max_retries=_MAX_RETRIES,
+            timeout=_HTTP_TIMEOUT,
+            http_client=http_client,
+        )
+        self.async_client = AsyncOpenAI(
+            base_url="https://openrouter.ai/api/v1",
+            api_key=api_key,
+            max_retries=_MAX_RETRIES,
+            timeout=_HTTP_TIMEOUT,
+            http_client=async_http_client,
         )
+        self.stream = stream
+
+    def chat_completion(
+        self, messages, response_format, model="openai/gpt-4o", max_completion_tokens=1000, temperature=NOT_GIVEN
+    ):
+        kwargs = {
+            "model": model,
+            "response_format": _response_format_schema(response_format),
+            "messages": messages,
+            "max_completion_tokens": max_completion_tokens,
+            "temperature": temperature,
+        }
+        if self.stream:
+            # stop reading as soon as the answer is a complete JSON object
+            reader = _JsonObjectReader()
+            with self.client.chat.completions.create(stream=True, **kwargs) as stream:
+                for chunk in stream:
+                    if chunk.choices and reader.feed(chunk.choices[0].delta.content or ""):
+                        break
+            # an unfinished object (truncation, refusal) is left to the caller's parse to report
+            return _completion_from_content(reader.content)
+
+        completion = self.client.chat.completions.create(**kwargs)
+        return completion
+
+    async def achat_completion(
+        self, messages, response_format, model="openai/gpt-4o", max_completion_tokens=1000, temperature=NOT_GIVEN
+    ):
+        kwargs = {
+            "model": model,
+            "response_format": _response_format_schema(response_format),
+            "messages": messages,
+            "max_completion_tokens": max_completion_tokens,
+            "temperature": temperature,
+        }
+        if self.stream:
+            reader = _JsonObjectReader()
+            async with await self.async_client.chat.completions.create(stream=True, **kwargs) as stream:
+                async for chunk in stream:
+                    if chunk.choices and reader.feed(chunk.choices[0].delta.content or ""):
+                        break
+            return _completion_from_content(reader.content)
+
+        completion = await self.async_client.chat.completions.create(**kwargs)
+        return completion
+
+
+def _completion_from_content(content: str):
+    # Only the raw content is cached - callers parse it the same way on hit or miss
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class CachedProvider(ModelProvider):
+    """Exact-match on-disk cache in front of another provider (for dev/test re-runs)"""
+
+    def __init__(self, provider: ModelProvider, path: str = ".llm_cache"):
+        self.provider = provider
+        self.path = path
+
+    def _key(self, messages, response_format, model) -> str:
+        payload = {"model": model, "msgs": messages, "schema": response_format.__name__}
+        return sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def _lookup(self, key: str):
+        with shelve.open(self.path) as cache:
+            return cache.get(key)
+
+    def _store(self, key: str, completion):
+        content = completion.choices[0].message.content
+        try:
+            json.loads(content)
+        except (TypeError, ValueError):
+            return  # never persist a truncated or refused answer
+        with shelve.open(self.path) as cache:
+            cache[key] = content
+
+    # only arguments the caller passed are forwarded, so the wrapped provider's defaults apply
+    def chat_completion(self, messages, response_format, **kwargs):
+        key = self._key(messages, response_format, kwargs.get("model"))
+        content = self._lookup(key)
+        if content is not None:
+            return _completion_from_content(content)
+
+        completion = self.provider.chat_completion(messages, response_format, **kwargs)
+        self._store(key, completion)
         return completion
 
+    async def achat_completion(self, messages, response_format, **kwargs):
+        key = self._key(messages, response_format, kwargs.get("model"))
+        content = self._lookup(key)
+        if content is not None:
+            return _completion_from_content(content)
+
+        completion = await self.provider.achat_completion(messages, response_format, **kwargs)
+        self._store(key, completion)
+        return completion
+
+
+def _load_default_embedder():
+    # optional dependency, only needed when the semantic cache is enabled
+    from sentence_transformers import SentenceTransformer
+
+    encoder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2", backend="onnx")
+    return lambda text: encoder.encode(text, normalize_embeddings=True)
+
 
-def create_model_provider(provider_type: str = None) -> ModelProvider:
-    load_dotenv(".env")
+class SemanticCache:
+    """Nearest-neighbour lookup of stored responses by cosine similarity of prompt embeddings"""
 
+    def __init__(self, embed, threshold: float = 0.92):
+        self.embed = embed
+        self.threshold = threshold
+        self.responses = []
+        self._vectors = []
+        self._matrix = None  # (N, d) float32, rebuilt lazily after inserts
+
+    def vector(self, text: str):
+        # embed() returns unit vectors, so the dot product below is the cosine similarity
+        q = np.asarray(self.embed(text), dtype=np.float32)
+        if not np.linalg.norm(q) > 0:
+            return None  # empty/degenerate text - no meaningful neighbours
+        return q
+
+    def get(self, q):
+        if not self.responses:
+            return None
+        if self._matrix is None:
+            self._matrix = np.ascontiguousarray(np.vstack(self._vectors), dtype=np.float32)
+
+        sims = self._matrix @ q
+        best = int(np.argmax(sims))
+        if sims[best] >= self.threshold:
+            return self.responses[best]
+        return None
+
+    def put(self, q, response: str):
+        self._vectors.append(q)
+        self.responses.append(response)
+        self._matrix = None
+
+
+class SemanticCachedProvider(ModelProvider):
+    """Serves near-duplicate prompts from a SemanticCache.
+
+    Only deterministic (temperature=0) calls are cached, and only responses whose
+    `function.tool` is in `cacheable_tools` - tools with side effects must never be replayed.
+    Caches are partitioned by the task (first user message) and the tool calls made so far,
+    so a response is only replayed at the same point of the same conversation - never into
+    a later step whose last message merely looks like an earlier one.
+    """
+
+    def __init__(self, provider: ModelProvider, cacheable_tools, embed=None, threshold: float = 0.92):
+        self.provider = provider
+        self.cacheable_tools = frozenset(cacheable_tools)
+        self.embed = embed or _load_default_embedder()
+        self.threshold = threshold
+        self.caches = {}
+
+    def _cache_for(self, messages, response_format, model):
+        task = next((m.get("content") for m in messages if m.get("role") == "user"), None)
+        calls = [call["function"] for m in messages if m.get("role") == "assistant" for call in m.get("tool_calls", [])]
+        history = sha256(json.dumps(calls, sort_keys=True).encode()).hexdigest()
+        key = (model, response_format.__name__, task, history)
+        if key not in self.caches:
+            self.caches[key] = SemanticCache(self.embed, self.threshold)
+        return self.caches[key]
+
+    def _store(self, cache: SemanticCache, q, completion):
+        if q is None:
+            return
+        content = completion.choices[0].message.content
+        try:
+            tool = json.loads(content).get("function", {}).get("tool")
+        except (TypeError, ValueError):
+            return  # truncated or refused answer, nothing to cache
+        if tool in self.cacheable_tools:
+            cache.put(q, content)
+
+    def chat_completion(self, messages, response_format, **kwargs):
+        if kwargs.get("temperature") != 0:
+            return self.provider.chat_completion(messages, response_format, **kwargs)
+
+        cache = self._cache_for(messages, response_format, kwargs.get("model"))
+        q = cache.vector(messages[-1].get("content") or "")
+        content = cache.get(q) if q is not None else None
+        if content is not None:
+            return _completion_from_content(content)
+
+        completion = self.provider.chat_completion(messages, response_format, **kwargs)
+        self._store(cache, q, completion)
+        return completion
+
+    async def achat_completion(self, messages, response_format, **kwargs):
+        if kwargs.get("temperature") != 0:
+            return await self.provider.achat_completion(messages, response_format, **kwargs)
+
+        cache = self._cache_for(messages, response_format, kwargs.get("model"))
+        # embedding is blocking model inference, keep it off the event loop
+        q = await asyncio.to_thread(cache.vector, messages[-1].get("content") or "")
+        content = cache.get(q) if q is not None else None
+        if content is not None:
+            return _completion_from_content(content)
+
+        completion = await self.provider.achat_completion(messages, response_format, **kwargs)
+        self._store(cache, q, completion)
+        return completion
+
+
+def create_model_provider(provider_type: str = None, cacheable_tools=()) -> ModelProvider:
     # Auto-detect provider if not specified
     if provider_type is None:
-        provider_type = os.getenv("MODEL_PROVIDER", "openai").lower()
+        provider_type = MODEL_PROVIDER
 
     if provider_type.lower() == "openai":
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+        if not OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY not found in environment variables")
-        return OpenAIProvider(api_key)
+        provider = OpenAIProvider(OPENAI_API_KEY, *_shared_http_clients(), stream=STREAM_COMPLETIONS)
     elif provider_type.lower() == "openrouter":
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if not api_key:
+        if not OPENROUTER_API_KEY:
             raise ValueError("OPENROUTER_API_KEY not found in environment variables")
-        return OpenRouterProvider(api_key)
+        provider = OpenRouterProvider(OPENROUTER_API_KEY, *_shared_http_clients(), stream=STREAM_COMPLETIONS)
     else:
         raise ValueError(f"Unsupported provider: {provider_type}")
 
+    # Cache is on by default for local iteration, set LLM_CACHE=false in production
+    if LLM_CACHE:
+        provider = CachedProvider(provider, path=LLM_CACHE_PATH)
+
+    # Semantic cache is opt-in and needs the side-effect-free tool names from the caller.
+    # It sits outside the exact cache so approximate hits are never persisted as exact answers.
+    if cacheable_tools and SEMANTIC_CACHE:
+        provider = SemanticCachedProvider(provider, cacheable_tools, threshold=SEMANTIC_CACHE_THRESHOLD)
+
+    return provider
+
 
 def get_model_name(provider_type: str = None) -> str:
     if provider_type is None:
-        provider_type = os.getenv("MODEL_PROVIDER", "openai").lower()
+        provider_type = MODEL_PROVIDER
 
     if provider_type.lower() == "openai":
-        return os.getenv("OPENAI_MODEL", "gpt-4o")
+        return OPENAI_MODEL
     elif provider_type.lower() == "openrouter":
-        return os.getenv("OPENROUTER_MODEL", "openai/gpt-4o")
+        return OPENROUTER_MODEL
     else:
         return "gpt-4o"
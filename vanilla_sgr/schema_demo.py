@@ -1,11 +1,15 @@
 # =============================================
 #  CMS in memory
 
-import json
+import asyncio
+from itertools import count
 from typing import Annotated, List, Literal, Union
 
+import numpy as np
+import orjson
 from annotated_types import Le, MaxLen, MinLen
-from pydantic import BaseModel, Field
+from openai import NOT_GIVEN
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 
 # using rich for pretty-printing in the console
 from rich.console import Console
@@ -13,12 +17,16 @@ from rich.panel import Panel
 from rich.rule import Rule
 
 # Import model providers
-from common.models import create_model_provider, get_model_name
+from common.models import SEMANTIC_CACHE, create_model_provider, get_model_name
 
 DB = {
     "rules": [],
     "invoices": {},
     "emails": [],
+    # secondary indexes for GetCustomerData, kept in sync on every insert
+    "rules_by_email": {},
+    "invoices_by_email": {},
+    "emails_by_to": {},
     "products": {
         "SKU-205": {"name": "AGI course 101 Personal", "price": 258},
         "SKU-210": {"name": "AGI 101 Course Team", "price": 1290},
@@ -26,10 +34,24 @@ DB = {
     },
 }
 
+# Flat price lookup for invoice totals, built once from the catalog at load time.
+# Prices of existing products are assumed immutable - nothing in the demo edits them.
+# Anything that changes a price in DB["products"] must rebuild SKU_INDEX/PRICES too,
+# the dict fallback in IssueInvoice only covers skus added after load.
+SKU_INDEX = {sku: i for i, sku in enumerate(DB["products"])}
+PRICES = np.array([p["price"] for p in DB["products"].values()], dtype=np.float64)
+
 
 # ==========================================
 # Tool calls
+
+# tool calls are immutable once parsed and never carry unknown fields
+_MODEL_CONFIG = ConfigDict(frozen=True, extra="forbid", populate_by_name=True)
+
+
 class SendEmail(BaseModel):
+    model_config = _MODEL_CONFIG
+
     tool: Literal["send_email"]
     subject: str
     message: str
@@ -40,6 +62,8 @@ class SendEmail(BaseModel):
 class GetCustomerData(BaseModel):
     """Gets customer data from our DB"""
 
+    model_config = _MODEL_CONFIG
+
     tool: Literal["get_customer_data"]
     email: str
 
@@ -47,6 +71,8 @@ class GetCustomerData(BaseModel):
 class IssueInvoice(BaseModel):
     """Issues invoice for the customer and specific skus"""
 
+    model_config = _MODEL_CONFIG
+
     tool: Literal["issue_invoice"]
     email: str
     skus: List[str]
@@ -56,6 +82,8 @@ class IssueInvoice(BaseModel):
 class CancelInvoice(BaseModel):
     """Cancels invoice with provided reason"""
 
+    model_config = _MODEL_CONFIG
+
     tool: Literal["cancel_invoice"]
     invoice_id: str
     reason: str
@@ -64,6 +92,8 @@ class CancelInvoice(BaseModel):
 class CreateRule(BaseModel):
     """Saves a custom rule for interacting with a customer"""
 
+    model_config = _MODEL_CONFIG
+
     tool: Literal["remember"]
     email: str
     rule: str
@@ -74,41 +104,44 @@ class CreateRule(BaseModel):
 # rules within the in-memory database.
 
 
-# ========================================
-# Dispatch function implementation
-def dispatch(cmd: BaseModel):
-
-    # ======================================
-    # Sending email
-    if isinstance(cmd, SendEmail):
-        email = {"to": cmd.recipient_email, "subject": cmd.subject, "message": cmd.message}
-
-        DB["emails"].append(email)
-        return email
-
-    # ============================================
-    # Implementation of the rest of the handlers
-
-    # ============================================
-    # Rule creation
-    if isinstance(cmd, CreateRule):
-        rule = {"email": cmd.email, "rule": cmd.rule}
-        DB["rules"].append(rule)
-        return rule
-
-    # ============================================
-    # Get customer data queries the DB
-    if isinstance(cmd, GetCustomerData):
-        addr = cmd.email
-        return {
-            "rules": [r for r in DB["rules"] if r["email"] == addr],
-            "invoices": [inv for inv in DB["invoices"].items() if inv[1]["email"] == addr],
-            "emails": [em for em in DB["emails"] if em.get("to") == addr],
-        }
-
-    # ============================================
-    # Issue invoice
-    if isinstance(cmd, IssueInvoice):
+# ======================================
+# Sending email
+def _handle_send_email(cmd: SendEmail):
+    email = {"to": cmd.recipient_email, "subject": cmd.subject, "message": cmd.message}
+
+    DB["emails"].append(email)
+    DB["emails_by_to"].setdefault(email["to"], []).append(email)
+    return email
+
+
+# ============================================
+# Rule creation
+def _handle_create_rule(cmd: CreateRule):
+    rule = {"email": cmd.email, "rule": cmd.rule}
+    DB["rules"].append(rule)
+    DB["rules_by_email"].setdefault(rule["email"], []).append(rule)
+    return rule
+
+
+# ============================================
+# Get customer data queries the DB
+def _handle_get_customer_data(cmd: GetCustomerData):
+    addr = cmd.email
+    return {
+        "rules": DB["rules_by_email"].get(addr, []),
+        "invoices": DB["invoices_by_email"].get(addr, []),
+        "emails": DB["emails_by_to"].get(addr, []),
+    }
+
+
+# ============================================
+# Issue invoice
+def _handle_issue_invoice(cmd: IssueInvoice):
+    idx = [SKU_INDEX.get(sku, -1) for sku in cmd.skus]
+    if -1 not in idx:
+        total = float(PRICES.take(idx).sum())
+    else:
+        # products added after load (or unknown skus) go through the catalog itself
         total = 0.0
         for sku in cmd.skus:
             product = DB["products"].get(sku)
@@ -116,59 +149,103 @@ def dispatch(cmd: BaseModel):
                 return f"Product {sku} not found"
             total += product["price"]
 
-        discount = round(total * 1.0 * cmd.discount_percent / 100.0, 2)
+    discount_amount = round(total * cmd.discount_percent / 100.0, 2)
 
-        invoice_id = f"INV-{len(DB['invoices']) + 1}"
+    invoice_id = f"INV-{len(DB['invoices']) + 1}"
 
-        invoice = {
-            "id": invoice_id,
-            "email": cmd.email,
-            "file": "/invoices" + invoice_id + ".pdf",
-            "skus": cmd.skus,
-            "discount_amount": discount,
-            "discount_percent": cmd.discount_percent,
-            "total": total,
-            "void": False,
-        }
+    invoice = {
+        "id": invoice_id,
+        "email": cmd.email,
+        "file": f"/invoices/{invoice_id}.pdf",
+        "skus": cmd.skus,
+        "discount_amount": discount_amount,
+        "discount_percent": cmd.discount_percent,
+        "total": total,
+        "void": False,
+    }
 
-        DB["invoices"][invoice_id] = invoice
-        return invoice
+    DB["invoices"][invoice_id] = invoice
+    DB["invoices_by_email"].setdefault(invoice["email"], []).append(invoice)
+    return invoice
 
-    if isinstance(cmd, CancelInvoice):
-        invoice = DB["invoices"].get(cmd.invoice_id)
-        if not invoice:
-            return f"Invoice {cmd.invoice_id} not found"
-        invoice["void"] = True
-        return invoice
+
+def _handle_cancel_invoice(cmd: CancelInvoice):
+    invoice = DB["invoices"].get(cmd.invoice_id)
+    if not invoice:
+        return f"Invoice {cmd.invoice_id} not found"
+    invoice["void"] = True
+    return invoice
+
+
+def _handle_report_completion(cmd):
+    # terminal step - the task loop stops on it, there is nothing to execute
+    return None
+
+
+# handlers keyed on each tool's `tool` literal
+_HANDLERS = {
+    "send_email": _handle_send_email,
+    "remember": _handle_create_rule,
+    "get_customer_data": _handle_get_customer_data,
+    "issue_invoice": _handle_issue_invoice,
+    "cancel_invoice": _handle_cancel_invoice,
+    "report_completion": _handle_report_completion,
+}
+
+
+# ========================================
+# Dispatch function implementation
+def dispatch(cmd: BaseModel):
+    return _HANDLERS[cmd.tool](cmd)
 
 
 # ==============================================================
 #  Test Tasks - https://abdullin.com/schema-guided-reasoning/demo
-TEST_TASKS = [
-    # 1. Should create a new rule for SAMA
-    "Rule: address sama@openai.com as 'The SAMA', always give him 5% discount",
-    # 2. Should create a rule for Elon
-    "Rule for elon@x.com. Email his invoices to finances@x.com",
-    # 3. Email for SAMA for each product
-    "sama@openai.com wants one of each product. Email him the invoice",
-    # 4. Evem more tricky
-    "elon@x.com wants 2x the way sama@openai.com got. Send the invoice",
-    # 5. Even more tricky - with discounts
-    "redo last elon@x.com invoice: use 3x discount of sama@openai.com",
+# Tasks in one stage are independent and run concurrently, stages run in order
+TEST_TASK_STAGES = [
+    [
+        # 1. Should create a new rule for SAMA
+        "Rule: address sama@openai.com as 'The SAMA', always give him 5% discount",
+        # 2. Should create a rule for Elon
+        "Rule for elon@x.com. Email his invoices to finances@x.com",
+    ],
+    [
+        # 3. Email for SAMA for each product (needs rule 1)
+        "sama@openai.com wants one of each product. Email him the invoice",
+    ],
+    [
+        # 4. Evem more tricky (needs rule 2 and the invoice from 3)
+        "elon@x.com wants 2x the way sama@openai.com got. Send the invoice",
+    ],
+    [
+        # 5. Even more tricky - with discounts (redoes the invoice from 4)
+        "redo last elon@x.com invoice: use 3x discount of sama@openai.com",
+    ],
 ]
 
 
 # ==============================================
 # Task Termination Command
 class ReportTaskCompletion(BaseModel):
+    model_config = _MODEL_CONFIG
+
     tool: Literal["report_completion"]
     completed_steps_laconic: List[str]
     code: Literal["completed", "failed"]
 
 
+def _tagged_union_as_any_of(schema: dict):
+    # validation dispatches on the `tool` tag, but strict structured outputs
+    # only accept plain anyOf - no oneOf / discriminator keywords
+    function = schema["properties"]["function"]
+    function["anyOf"] = function.pop("oneOf")
+    function.pop("discriminator", None)
+
+
 # ==============================================
 # Prompt Engineering
 class NextStep(BaseModel):
+    model_config = ConfigDict(_MODEL_CONFIG, json_schema_extra=_tagged_union_as_any_of)
 
     # some thinking space here
     current_task: str
@@ -181,10 +258,14 @@ class NextStep(BaseModel):
     task_completed: bool
 
     function: Union[ReportTaskCompletion, CancelInvoice, IssueInvoice, GetCustomerData, SendEmail, CreateRule] = Field(
-        ..., description="Execute first remaining step"
+        ..., discriminator="tool", description="Execute first remaining step"
     )
 
 
+# compiled once - pydantic-core parses the JSON straight into the model
+_NEXTSTEP_TA = TypeAdapter(NextStep)
+
+
 # ==============================================
 #  All of the products are loaded into one system prompt - the bigger the prompt - maybe loading tools conditionally
 SYSTEM_PROMPT = f"""
@@ -199,6 +280,15 @@ SYSTEM_PROMPT = f"""
     Products: {DB['products']}
 """.strip()
 
+# shared by every task - messages are only read by the SDK, never mutated
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Keep at most this many tool call/result pairs in the log. Older pairs are dropped
+# so the request body stops growing with every step. SGR plans each step from the
+# task and recent results, but a dropped early result (e.g. customer data) has to be
+# fetched again if the agent still needs it.
+MAX_HISTORY = 8
+
 
 # ===============================================
 # Tasks Processing
@@ -207,66 +297,87 @@ console = Console()
 print = console.print
 
 # Initialize model provider
-model_provider = create_model_provider()
+# only side-effect-free steps may be served from the (optional) semantic cache
+model_provider = create_model_provider(cacheable_tools={"get_customer_data", "report_completion"})
 model_name = get_model_name()
 
-
-def execute_tasks():
+# the semantic cache only serves deterministic calls, otherwise keep the model's default sampling
+# (reasoning models reject an explicit temperature)
+temperature = 0 if SEMANTIC_CACHE else NOT_GIVEN
+
+
+async def run_task(task: str, number: int):
+    # concurrent tasks interleave their output, so every step line carries the task number
+    label = f"[dim]task {number}[/dim]"
+
+    print("\n\n")
+    print(Panel(task, title=f"Launch agent with task {number}", title_align="left"))
+
+    log = [SYSTEM_MSG, {"role": "user", "content": task}]
+
+    # Up to 20 reasoning steps
+    for i in range(20):
+        step = f"step_{i+1}"
+        print(f"{label} Planning {step}... {model_name}")
+        completion = await model_provider.achat_completion(
+            model=model_name,
+            response_format=NextStep,
+            messages=log,
+            max_completion_tokens=1000,
+            temperature=temperature,
+        )
+
+        # Parse JSON response manually since OpenRouter returns JSON as string
+        response_content = completion.choices[0].message.content
+        job = _NEXTSTEP_TA.validate_json(response_content)
+
+        if isinstance(job.function, ReportTaskCompletion):
+            print(f"{label} [blue]agent {job.function.code}[/blue].")
+            print(Rule(f"Summary - task {number}"))
+            for s in job.function.completed_steps_laconic:
+                print(f"- {s}")
+            print(Rule())
+            break
+
+        print(label, job.plan_remaining_steps_brief[0], f"\n  {job.function}")
+
+        log.append(
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        "type": "function",
+                        "id": step,
+                        "function": {
+                            "name": job.function.tool,
+                            "arguments": job.function.model_dump_json(),
+                        },
+                    }
+                ],
+            }
+        )
+
+        result = dispatch(job.function)
+        txt = result if isinstance(result, str) else orjson.dumps(result).decode()
+
+        log.append({"role": "tool", "content": txt, "tool_call_id": step})
+
+        # the system prompt and the task itself always stay at log[0:2]
+        if len(log) > 2 + 2 * MAX_HISTORY:
+            del log[2:4]
+
+
+async def execute_tasks(stages=None):
+    if stages is None:
+        stages = TEST_TASK_STAGES
 
     # ==============================================
-    # we are executing tasks sequentially.
-
-    for task in TEST_TASKS:
-        print("\n\n")
-        print(Panel(task, title="Launch agent with task", title_align="left"))
-
-        log = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": task}]
-
-        # Up to 20 reasoning steps
-        for i in range(20):
-            step = f"step_{i+1}"
-            print(f"Planning {step}... ", end="")
-            print(model_name)
-            completion = model_provider.chat_completion(
-                model=model_name,
-                response_format=NextStep,
-                messages=log,
-                max_completion_tokens=1000,
-            )
-
-            # Parse JSON response manually since OpenRouter returns JSON as string
-            response_content = completion.choices[0].message.content
-            job_dict = json.loads(response_content)
-            job = NextStep.model_validate(job_dict)
-
-            if isinstance(job.function, ReportTaskCompletion):
-                print(f"[blue]agent {job.function.code}[/blue].")
-                print(Rule("Summary"))
-                for s in job.function.completed_steps_laconic:
-                    print(f"- {s}")
-                print(Rule())
-                break
-
-            print(job.plan_remaining_steps_brief[0], f"\n  {job.function}")
-
-            log.append(
-                {
-                    "role": "assistant",
-                    "tool_calls": [
-                        {
-                            "type": "function",
-                            "id": step,
-                            "function": {"name": job.function.tool, "arguments": job.function.model_dump_json()},
-                        }
-                    ],
-                }
-            )
-
-            result = dispatch(job.function)
-            txt = result if isinstance(result, str) else json.dumps(result)
-
-            log.append({"role": "tool", "content": txt, "tool_call_id": step})
+    # dispatch never awaits, so DB updates from concurrent tasks stay atomic
+
+    numbers = count(1)
+    for stage in stages:
+        await asyncio.gather(*[run_task(task, next(numbers)) for task in stage])
 
 
 if __name__ == "__main__":
-    execute_tasks()
+    asyncio.run(execute_tasks())